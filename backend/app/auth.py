@@ -1,74 +1,37 @@
-# from datetime import datetime, timedelta
-# from typing import Optional
-# from jose import JWTError, jwt
-# from passlib.context import CryptContext
-# from fastapi import HTTPException, status, Depends
-# from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-# from sqlalchemy.orm import Session
-# from . import models, schemas, config
-
-# pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-# security = HTTPBearer()
-
-# def verify_password(plain_password, hashed_password):
-#     return pwd_context.verify(plain_password, hashed_password)
-
-# # def get_password_hash(password):
-# #     return pwd_context.hash(password)
-# def get_password_hash(password: str) -> str:
-#     # Truncate password to 72 bytes to comply with bcrypt limit
-#     if len(password.encode('utf-8')) > 72:
-#         password = password.encode('utf-8')[:72].decode('utf-8', 'ignore')
-#     return pwd_context.hash(password)
-
-# def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-#     to_encode = data.copy()
-#     if expires_delta:
-#         expire = datetime.utcnow() + expires_delta
-#     else:
-#         expire = datetime.utcnow() + timedelta(minutes=config.settings.JWT_EXPIRE_MINUTES)
-#     to_encode.update({"exp": expire})
-#     encoded_jwt = jwt.encode(to_encode, config.settings.JWT_SECRET_KEY, algorithm=config.settings.JWT_ALGORITHM)
-#     return encoded_jwt
-
-# def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-#     credentials_exception = HTTPException(
-#         status_code=status.HTTP_401_UNAUTHORIZED,
-#         detail="Could not validate credentials",
-#         headers={"WWW-Authenticate": "Bearer"},
-#     )
-#     try:
-#         payload = jwt.decode(credentials.credentials, config.settings.JWT_SECRET_KEY, algorithms=[config.settings.JWT_ALGORITHM])
-#         student_id: int = payload.get("sub")
-#         if student_id is None:
-#             raise credentials_exception
-#         return schemas.TokenData(student_id=student_id)
-#     except JWTError:
-#         raise credentials_exception
-
-# def authenticate_student(db: Session, email: str, password: str):
-#     student = db.query(models.Student).filter(models.Student.email == email).first()
-#     if not student:
-#         return False
-#     if not verify_password(password, student.password_hash):
-#         return False
-#     return student
-
-
-from datetime import datetime, timedelta
+import asyncio
+import hashlib
+import hmac
+import logging
+import time
+from datetime import timedelta
 from typing import Optional
+from cachetools import TLRUCache
 from jose import JWTError, jwt
-from passlib.context import CryptContext
-from fastapi import HTTPException, status, Depends
+from fastapi import HTTPException, status, Depends, Header
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from . import models, schemas, config
 
-# Use bcrypt directly instead of passlib's bcrypt to avoid compatibility issues
+# Use bcrypt directly rather than passlib's CryptContext dispatcher
 import bcrypt
 
+logger = logging.getLogger(__name__)
+
 security = HTTPBearer()
 
+# Verified tokens keyed by a digest of the raw token; each entry expires at the token's own exp claim
+_token_cache = TLRUCache(maxsize=10000, ttu=lambda key, value, now: value[0], timer=time.time)
+
+_EXP_SECONDS = config.settings.JWT_EXPIRE_MINUTES * 60
+
+# Decode parameters built once; python-jose rejects tokens missing exp or sub
+_JWT_ALGORITHMS = [config.settings.JWT_ALGORITHM]
+_JWT_DECODE_OPTIONS = {"require_exp": True, "require_sub": True}
+
+# Hash checked against when the email is unknown, keeping login timing uniform
+_DUMMY_HASH = bcrypt.hashpw(b"x", bcrypt.gensalt(rounds=config.settings.BCRYPT_COST))
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against a bcrypt hash"""
     try:
@@ -80,7 +43,7 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
         
         return bcrypt.checkpw(plain_password, hashed_password)
     except Exception as e:
-        print(f"Password verification error: {e}")
+        logger.warning("Password verification error: %s", e)
         return False
 
 def get_password_hash(password: str) -> str:
@@ -92,16 +55,16 @@ def get_password_hash(password: str) -> str:
         # Truncate password if it's too long for bcrypt (72 bytes max)
         if len(password_bytes) > 72:
             password_bytes = password_bytes[:72]
-            print("Warning: Password truncated to 72 bytes for bcrypt")
+            logger.debug("Password truncated to 72 bytes for bcrypt")
         
         # Generate salt and hash
-        salt = bcrypt.gensalt()
+        salt = bcrypt.gensalt(rounds=config.settings.BCRYPT_COST)
         hashed = bcrypt.hashpw(password_bytes, salt)
         
         # Return as string for database storage
         return hashed.decode('utf-8')
     except Exception as e:
-        print(f"Password hashing error: {e}")
+        logger.error("Password hashing error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Error processing password"
@@ -110,11 +73,11 @@ def get_password_hash(password: str) -> str:
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
+    # exp as integer POSIX seconds; no datetime objects on the default path
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        to_encode["exp"] = int(time.time() + expires_delta.total_seconds())
     else:
-        expire = datetime.utcnow() + timedelta(minutes=config.settings.JWT_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+        to_encode["exp"] = int(time.time()) + _EXP_SECONDS
     
     # Ensure 'sub' claim is a string (JWT requirement)
     if 'sub' in to_encode and not isinstance(to_encode['sub'], str):
@@ -125,48 +88,84 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def _token_cache_key(token: str) -> bytes:
+    """16-byte blake2b digest of a raw token, used as the verification cache key"""
+    # Header values are latin-1 decoded, so this never fails and is a 1:1 byte copy for JWTs
+    return hashlib.blake2b(token.encode("latin-1"), digest_size=16).digest()
+
+
+# async so FastAPI runs it on the event loop rather than the threadpool: it does no I/O, and
+# _token_cache (a cachetools cache) is not safe to touch from several threads at once
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    print(f"🔐 Token verification started")
-    print(f"📨 Received credentials: {credentials.credentials[:20]}...")
+    cache_key = _token_cache_key(credentials.credentials)
+    cached = _token_cache.get(cache_key)
+    if cached is not None:
+        return cached[1]
     
     try:
         payload = jwt.decode(
-            credentials.credentials, 
-            config.settings.JWT_SECRET_KEY, 
-            algorithms=[config.settings.JWT_ALGORITHM]
+            credentials.credentials,
+            config.settings.JWT_SECRET_KEY,
+            algorithms=_JWT_ALGORITHMS,
+            options=_JWT_DECODE_OPTIONS,
         )
         student_id_str: str = payload.get("sub")
-        print(f"✅ Token decoded successfully. Student ID (string): {student_id_str}")
-        print(f"📋 Token payload: {payload}")
+        logger.debug("Token decoded sub=%s", student_id_str)
         
         if student_id_str is None:
-            print("❌ No student ID in token")
+            logger.debug("No student ID in token")
             raise credentials_exception
         
         # Convert string student_id back to integer for database use
         try:
             student_id = int(student_id_str)
         except (ValueError, TypeError):
-            print("❌ Invalid student ID format in token")
+            logger.debug("Invalid student ID format in token")
             raise credentials_exception
+        
+        token_data = schemas.TokenData(student_id=student_id)
+        
+        # Only successfully verified tokens are cached
+        expires_at = payload.get("exp")
+        if isinstance(expires_at, (int, float)) and expires_at > time.time():
+            _token_cache[cache_key] = (expires_at, token_data)
             
-        return schemas.TokenData(student_id=student_id)
+        return token_data
         
     except JWTError as e:
-        print(f"❌ JWT Error: {e}")
+        logger.debug("JWT error: %s", e)
         raise credentials_exception
 
 
-def authenticate_student(db: Session, email: str, password: str):
-    student = db.query(models.Student).filter(models.Student.email == email).first()
-    if not student:
-        return False
-    if not verify_password(password, student.password_hash):
-        return False
-    return student
\ No newline at end of file
+def verify_internal_token(x_internal_token: Optional[str] = Header(None, alias="X-Internal-Token")):
+    """Guard for endpoints only the n8n workflow may call"""
+    secret = config.settings.INTERNAL_SECRET
+    # Fail closed when no secret is configured; compare in constant time otherwise
+    if not secret or x_internal_token is None or not hmac.compare_digest(
+        x_internal_token.encode(), secret.encode()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid internal token",
+        )
+
+
+async def authenticate_student(db: AsyncSession, email: str, password: str) -> Optional[int]:
+    """Return the student's id if the credentials are valid, otherwise None"""
+    # Only the columns needed for verification are fetched
+    result = await db.execute(
+        select(models.Student.id, models.Student.password_hash).where(models.Student.email == email)
+    )
+    row = result.first()
+    # Always run bcrypt so unknown emails take as long as wrong passwords;
+    # it is deliberately slow, so keep it off the event loop
+    password_ok = await asyncio.to_thread(
+        verify_password, password, row.password_hash if row else _DUMMY_HASH
+    )
+    return row.id if (row and password_ok) else None
\ No newline at end of file
@@ -8,8 +8,16 @@ class Settings:
     JWT_SECRET_KEY: str = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
     JWT_ALGORITHM: str = "HS256"
     JWT_EXPIRE_MINUTES: int = 30
+    BCRYPT_COST: int = int(os.getenv("BCRYPT_COST", "12"))
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY")
     N8N_WEBHOOK_URL: str = os.getenv("N8N_WEBHOOK_URL", "https://turemobedaso.app.n8n.cloud/webhook/assignment")
+    # Shared secret n8n sends as X-Internal-Token when calling /internal endpoints
+    INTERNAL_SECRET: str = os.getenv("INTERNAL_SECRET", "")
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+    # Width of stored embeddings (text-embedding-3 models shorten server-side to this).
+    # Not read from the environment: data/init.sql and data/migrations must declare the same
+    # width for academic_sources.embedding, its bit index and query_embedding_cache
+    EMBEDDING_DIMENSIONS: int = 512
     
     # File upload settings
     UPLOAD_DIR: str = "uploads"
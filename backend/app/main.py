@@ -1,148 +1,112 @@
+import asyncio
+import dataclasses
+import logging
 import uuid
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form
 from fastapi.security import HTTPBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 import os
-import shutil
 from typing import List
-import requests
-import json
+import httpx
+import aiofiles
+import orjson
 
 from fastapi import Request
 from . import models, schemas, auth, rag_service, database
 from .config import settings
-from .auth import verify_token
+from .auth import verify_token, verify_internal_token
+
+# Uvicorn only configures its own loggers; without this the root logger drops app INFO records
+logging.basicConfig(level=settings.LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+# Leading bytes expected for each binary upload type (.txt has no signature)
+_FILE_SIGNATURES = {
+    '.pdf': b"%PDF",
+    '.docx': b"PK\x03\x04",
+    '.doc': b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1",
+}
 
 # Create upload directory
 os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
 
-app = FastAPI(title="Academic Assignment Helper API", version="1.0.0")
+app = FastAPI(
+    title="Academic Assignment Helper API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
+
+# Shared client so n8n webhook calls reuse keep-alive connections
+n8n_client = httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_keepalive_connections=32))
+
+# Built once at startup instead of per /sources request
+rag_instance = rag_service.RAGService()
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await n8n_client.aclose()
+    await rag_instance.aclose()
 
 # Dependency
-def get_db():
-    db = database.SessionLocal()
-    try:
+async def get_db():
+    async with database.SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # Auth endpoints
 @app.post("/auth/register", response_model=schemas.StudentResponse)
-def register(student: schemas.StudentCreate, db: Session = Depends(get_db)):
-    # Check if student already exists
-    db_student = db.query(models.Student).filter(models.Student.email == student.email).first()
-    if db_student:
-        raise HTTPException(status_code=400, detail="Email already registered")
+async def register(student: schemas.StudentCreate, db: AsyncSession = Depends(get_db)):
+    hashed_password = await asyncio.to_thread(auth.get_password_hash, student.password)
     
-    # Create new student
-    hashed_password = auth.get_password_hash(student.password)
-    db_student = models.Student(
-        email=student.email,
-        password_hash=hashed_password,
-        full_name=student.full_name,
-        student_id=student.student_id
+    # Insert in one round-trip; the unique email index reports duplicates instead of a prior SELECT
+    stmt = (
+        insert(models.Student)
+        .values(
+            email=student.email,
+            password_hash=hashed_password,
+            full_name=student.full_name,
+            student_id=student.student_id
+        )
+        .on_conflict_do_nothing(index_elements=["email"])
+        .returning(models.Student)
     )
-    db.add(db_student)
-    db.commit()
-    db.refresh(db_student)
+    db_student = await db.scalar(stmt)
+    if db_student is None:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    await db.commit()
     
     # Create token with string student ID
     access_token = auth.create_access_token(data={"sub": str(db_student.id)})
-    print(f"✅ Registered student {db_student.id}, token created")
+    logger.debug("Registered student %s, token created", db_student.id)
     
-    return db_student
+    return schemas.StudentResponse.model_validate(db_student)
 
 
 
 @app.post("/auth/login", response_model=schemas.Token)
-def login(email: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
-    student = auth.authenticate_student(db, email, password)
-    if not student:
+async def login(email: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_db)):
+    student_id = await auth.authenticate_student(db, email, password)
+    if student_id is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Convert student.id to string for JWT compliance
-    access_token = auth.create_access_token(data={"sub": str(student.id)})
+    # Convert the student id to string for JWT compliance
+    access_token = auth.create_access_token(data={"sub": str(student_id)})
     
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-# @app.post("/upload", response_model=dict)
-# async def upload_assignment(
-#     file: UploadFile = File(...),
-#     token_data: schemas.TokenData = Depends(verify_token),
-#     db: Session = Depends(get_db)
-# ):
-#     # Validate file type
-#     allowed_extensions = {'.pdf', '.docx', '.doc', '.txt'}
-#     file_extension = os.path.splitext(file.filename)[1].lower()
-#     if file_extension not in allowed_extensions:
-#         raise HTTPException(status_code=400, detail="File type not allowed")
-    
-#     # Create uploads directory if it doesn't exist
-#     os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
-    
-#     # Save file with unique name to avoid conflicts
-#     unique_filename = f"{uuid.uuid4()}_{file.filename}"
-#     file_path = os.path.join(settings.UPLOAD_DIR, unique_filename)
-    
-#     with open(file_path, "wb") as buffer:
-#         shutil.copyfileobj(file.file, buffer)
-    
-#     # Create assignment record
-#     assignment = models.Assignment(
-#         student_id=token_data.student_id,
-#         filename=unique_filename,
-#         original_text=f"File stored at: {file_path}"  # We'll extract text in n8n
-#     )
-#     db.add(assignment)
-#     db.commit()
-#     db.refresh(assignment)
-    
-#     print(f"✅ File uploaded: {unique_filename}, Assignment ID: {assignment.id}")
-    
-#     # Trigger n8n workflow
-#     try:
-#         webhook_data = {
-#             "assignment_id": assignment.id,
-#             "filename": unique_filename,
-#             "file_path": file_path,
-#             "student_id": token_data.student_id,
-#             "original_filename": file.filename
-#         }
-        
-#         print(f"🚀 Triggering n8n workflow with data: {webhook_data}")
-        
-#         response = requests.post(
-#             settings.N8N_WEBHOOK_URL, 
-#             json=webhook_data,
-#             timeout=30
-#         )
-        
-#         if response.status_code == 200:
-#             print("✅ n8n webhook triggered successfully")
-#         else:
-#             print(f"⚠️ n8n webhook returned status: {response.status_code}")
-    
-#     except Exception as e:
-#         print(f"❌ Error calling n8n webhook: {e}")
-    
-#     return {
-#         "message": "File uploaded successfully", 
-#         "assignment_id": assignment.id, 
-#         "analysis_job_id": assignment.id
-#     }
-
 @app.post("/upload", response_model=dict)
 async def upload_assignment(
     request: Request,
     file: UploadFile = File(...),
     token_data: schemas.TokenData = Depends(verify_token),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Validate file type
     allowed_extensions = {'.pdf', '.docx', '.doc', '.txt'}
@@ -150,15 +114,25 @@ async def upload_assignment(
     if file_extension not in allowed_extensions:
         raise HTTPException(status_code=400, detail="File type not allowed")
     
+    # Check the signature on the first chunk, before anything reaches disk or the DB
+    chunk = await file.read(1 << 20)
+    signature = _FILE_SIGNATURES.get(file_extension)
+    if signature and not chunk.startswith(signature):
+        raise HTTPException(status_code=400, detail="File content does not match its type")
+    
     # Create uploads directory if it doesn't exist
     os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
     
-    # Save file with unique name to avoid conflicts
-    unique_filename = f"{uuid.uuid4()}_{file.filename}"
+    # Save file with unique name to avoid conflicts; basename strips any client-supplied directories
+    safe_name = os.path.basename(file.filename)
+    unique_filename = uuid.uuid4().hex + "_" + safe_name
     file_path = os.path.join(settings.UPLOAD_DIR, unique_filename)
     
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Stream to disk in 1 MiB chunks so the event loop stays free between writes
+    async with aiofiles.open(file_path, "wb") as buffer:
+        while chunk:
+            await buffer.write(chunk)
+            chunk = await file.read(1 << 20)
     
     # Create assignment record
     assignment = models.Assignment(
@@ -167,14 +141,13 @@ async def upload_assignment(
         original_text=f"File stored at: {file_path}"  # We'll extract text in n8n
     )
     db.add(assignment)
-    db.commit()
-    db.refresh(assignment)
+    await db.commit()
     
-    print(f"✅ File uploaded: {unique_filename}, Assignment ID: {assignment.id}")
+    logger.debug("File uploaded: %s, assignment_id=%s", unique_filename, assignment.id)
     
     # Trigger n8n workflow
     try:
-            # Get the Authorization header from the original request
+        # Get the Authorization header from the original request
         auth_header = request.headers.get("authorization", "")
         token = auth_header.replace("Bearer ", "") if auth_header.startswith("Bearer ") else ""
         webhook_data = {
@@ -186,33 +159,21 @@ async def upload_assignment(
             "token":token
         }
         
-        print(f"🚀 Triggering n8n workflow with data: {webhook_data}")
-        
-        # ADD DEBUG LOGGING HERE
-        print(f"🔗 N8N_WEBHOOK_URL from settings: {settings.N8N_WEBHOOK_URL}")
-        print(f"🔗 Full webhook URL being used: {settings.N8N_WEBHOOK_URL}")
+        logger.debug("Triggering n8n workflow at %s for assignment_id=%s", settings.N8N_WEBHOOK_URL, assignment.id)
         
-        response = requests.post(
-            settings.N8N_WEBHOOK_URL, 
-            json=webhook_data,
-            timeout=60
+        response = await n8n_client.post(
+            settings.N8N_WEBHOOK_URL,
+            content=orjson.dumps(webhook_data),
+            headers={"Content-Type": "application/json"},
         )
         
-        # ADD MORE DEBUGGING
-        print(f"📡 n8n response status: {response.status_code}")
-        print(f"📡 n8n response headers: {dict(response.headers)}")
-        if response.status_code != 200:
-            print(f"📡 n8n response text: {response.text}")
-        
         if response.status_code == 200:
-            print("✅ n8n webhook triggered successfully")
+            logger.debug("n8n webhook triggered successfully")
         else:
-            print(f"⚠️ n8n webhook returned status: {response.status_code}")
+            logger.warning("n8n webhook returned status %s: %s", response.status_code, response.text)
     
-    except Exception as e:
-        print(f"❌ Error calling n8n webhook: {e}")
-        import traceback
-        print(f"❌ Full traceback: {traceback.format_exc()}")
+    except Exception:
+        logger.exception("Error calling n8n webhook")
     
     return {
         "message": "File uploaded successfully", 
@@ -223,50 +184,55 @@ async def upload_assignment(
 
 
 @app.get("/analysis/{analysis_id}", response_model=schemas.AnalysisResultResponse)
-def get_analysis(
+async def get_analysis(
     analysis_id: int,
     token_data: schemas.TokenData = Depends(verify_token),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    # Verify the assignment belongs to the student
-    analysis = db.query(models.AnalysisResult).filter(models.AnalysisResult.id == analysis_id).first()
+    # Fetch the analysis only if its assignment belongs to the student
+    result = await db.execute(
+        select(models.AnalysisResult)
+        .join(models.Assignment, models.AnalysisResult.assignment_id == models.Assignment.id)
+        .where(
+            models.AnalysisResult.id == analysis_id,
+            models.Assignment.student_id == token_data.student_id,
+        )
+    )
+    analysis = result.scalars().first()
     if not analysis:
         raise HTTPException(status_code=404, detail="Analysis not found")
     
-    assignment = db.query(models.Assignment).filter(models.Assignment.id == analysis.assignment_id).first()
-    if assignment.student_id != token_data.student_id:
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    return analysis
+    return schemas.AnalysisResultResponse.model_validate(analysis)
 
 
 
 
 @app.get("/sources", response_model=schemas.SourceSearchResponse)
-def search_sources(
+async def search_sources(
     query: str,
     token_data: schemas.TokenData = Depends(verify_token),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    rag = rag_service.RAGService()
-    sources = rag.search_similar_sources(db, query)
-    return {"query": query, "sources": sources}
+    rag = rag_instance
+    sources = await rag.search_similar_sources(db, query)
+    return {"query": query, "sources": [dataclasses.asdict(source) for source in sources]}
 
 
 
 # Internal endpoint for n8n to store analysis results
-@app.post("/internal/store-analysis")
+@app.post("/internal/store-analysis", dependencies=[Depends(verify_internal_token)])
 async def store_analysis_results(
     request: dict,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Internal endpoint for n8n workflow to store analysis results
+    Requires the X-Internal-Token header to match INTERNAL_SECRET
     Expects JSON with: assignment_id, suggested_sources, plagiarism_score, 
     flagged_sections, research_suggestions, citation_recommendations, confidence_score
     """
     try:
-        print(f"📥 Received analysis results for assignment: {request}")
+        logger.debug("Received analysis results for assignment_id=%s", request.get("assignment_id"))
         
         # Extract data from request
         assignment_id = request.get("assignment_id")
@@ -278,7 +244,8 @@ async def store_analysis_results(
         confidence_score = request.get("confidence_score", 0.0)
         
         # Validate assignment exists
-        assignment = db.query(models.Assignment).filter(models.Assignment.id == assignment_id).first()
+        result = await db.execute(select(models.Assignment.id).where(models.Assignment.id == assignment_id))
+        assignment = result.scalar_one_or_none()
         if not assignment:
             return JSONResponse(
                 status_code=404,
@@ -297,10 +264,9 @@ async def store_analysis_results(
         )
         
         db.add(analysis)
-        db.commit()
-        db.refresh(analysis)
+        await db.commit()
         
-        print(f"✅ Analysis stored with ID: {analysis.id}")
+        logger.debug("Analysis stored with ID: %s", analysis.id)
         
         return {
             "status": "success", 
@@ -309,8 +275,8 @@ async def store_analysis_results(
         }
         
     except Exception as e:
-        db.rollback()
-        print(f"❌ Error storing analysis: {e}")
+        await db.rollback()
+        logger.error("Error storing analysis: %s", e)
         return JSONResponse(
             status_code=500,
             content={"error": f"Failed to store analysis: {str(e)}"}
@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Text, Float, DateTime, JSON, ForeignKey
+from sqlalchemy import Column, Computed, Integer, String, Text, Float, DateTime, JSON, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import HALFVEC
+from .config import settings
 
 Base = declarative_base()
 
@@ -19,7 +20,7 @@ class Assignment(Base):
     __tablename__ = "assignments"
     
     id = Column(Integer, primary_key=True, index=True)
-    student_id = Column(Integer, ForeignKey("students.id"))
+    student_id = Column(Integer, ForeignKey("students.id"), index=True)
     filename = Column(String)
     original_text = Column(Text)
     topic = Column(String)
@@ -31,7 +32,7 @@ class AnalysisResult(Base):
     __tablename__ = "analysis_results"
     
     id = Column(Integer, primary_key=True, index=True)
-    assignment_id = Column(Integer, ForeignKey("assignments.id"))
+    assignment_id = Column(Integer, ForeignKey("assignments.id"), index=True)
     suggested_sources = Column(JSON)
     plagiarism_score = Column(Float)
     flagged_sections = Column(JSON)
@@ -50,4 +51,7 @@ class AcademicSource(Base):
     abstract = Column(Text)
     full_text = Column(Text)
     source_type = Column(String)  # 'paper', 'textbook', 'course_material'
-    embedding = Column(Vector(1536))
\ No newline at end of file
+    # Half-precision storage halves heap and HNSW index memory per row
+    embedding = Column(HALFVEC(settings.EMBEDDING_DIMENSIONS))
+    # Text the embedding is generated from, maintained by PostgreSQL
+    embedding_input = Column(Text, Computed("coalesce(title, '') || '. ' || coalesce(abstract, '')", persisted=True))
\ No newline at end of file
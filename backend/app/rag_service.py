@@ -1,123 +1,536 @@
-import openai
-from sqlalchemy.orm import Session
-from sqlalchemy import text
+import asyncio
+import base64
+import contextlib
+import copy
+import dataclasses
+import functools
+import hashlib
+import logging
+import httpx
+import numpy as np
+import orjson
+import tiktoken
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from cachetools import LRUCache, TTLCache
+from collections import defaultdict, deque
+from tqdm import tqdm
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import Integer, String, bindparam, text
 import json
-from typing import List, Dict, Any
-from . import models, config
+from typing import Iterator, List, Dict, Any, Optional, Tuple
+from . import config
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = config.settings.EMBEDDING_DIMENSIONS
+# Inputs sent per embeddings request during backfills
+EMBEDDING_BATCH_SIZE = 100
+# The embeddings endpoint rejects any input longer than this many tokens
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+# Token budget for all inputs of one embeddings request
+EMBEDDING_MAX_BATCH_TOKENS = 8191 * 16
+ANALYSIS_MODEL = "gpt-4o-mini"
+# Assignment text sent for analysis, in tokens
+ANALYSIS_MAX_INPUT_TOKENS = 1500
+ANALYSIS_MAX_OUTPUT_TOKENS = 400
+# How long an analysis is reused for identical text and sources
+ANALYSIS_CACHE_TTL = 24 * 60 * 60
+
+# HNSW candidate list size for similarity queries (pgvector default is 40)
+HNSW_EF_SEARCH = 40
+# Binary-quantized candidates fetched before exact reranking, and the HNSW search width for them
+RERANK_CANDIDATES = 50
+RERANK_EF_SEARCH = 80
+# Batch API limits: requests and bytes per input file (200 MB, less headroom), and how often
+# to check a running batch
+EMBEDDING_BATCH_API_MAX_REQUESTS = 50000
+EMBEDDING_BATCH_API_MAX_BYTES = 190 * 1024 * 1024
+EMBEDDING_BATCH_API_POLL_SECONDS = 60
+# Connection pool shared by all OpenAI requests; long keep-alive avoids TLS re-handshakes
+# between bursts of backfill requests
+OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60.0)
+OPENAI_HTTP_TIMEOUT = 30.0
+# Backfill windows written between commits
+BACKFILL_COMMIT_EVERY = 10
+# Embeddings requests in flight at once during backfills (also the number of windows embedded ahead)
+EMBEDDING_CONCURRENCY = 20
+
+
+# Statements are built once. asyncpg prepares and caches each one per connection, so repeat
+# executions skip parsing and planning. :embedding stays untyped so its value goes through
+# pgvector's binary asyncpg codec rather than the SQLAlchemy type's text bind processor
+
+# Embeddings are unit length, so negative inner product (<#>) ranks exactly like cosine
+# distance without the norm divisions; 1 + (<#>) is the cosine distance reported before.
+# The inner query selects the distance as the same bare expression it orders by, so
+# pgvector evaluates it once per row and can use the HNSW index; filters belong in the
+# outer query, where they reuse `distance` instead of recomputing the operator
+_SEARCH_SQL = text("""
+    SELECT id, title, authors, publication_year, abstract, source_type,
+        1 + distance as similarity
+    FROM (
+        SELECT id, title, authors, publication_year, abstract, source_type,
+            embedding <#> :embedding AS distance
+        FROM academic_sources
+        ORDER BY embedding <#> :embedding
+        LIMIT :top_k
+    ) AS candidates
+    ORDER BY distance
+""").bindparams(bindparam("top_k", type_=Integer))
+
+# Candidates come from the binary_quantize expression index (Hamming distance, <~>), then the
+# stored halfvec embeddings rerank just those rows. The expression must match the index exactly
+_RERANKED_SEARCH_SQL = text(f"""
+    WITH candidates AS (
+        SELECT id
+        FROM academic_sources
+        ORDER BY binary_quantize(embedding)::bit({EMBEDDING_DIMENSIONS}) <~> binary_quantize(CAST(:embedding AS halfvec))
+        LIMIT :candidates
+    )
+    SELECT s.id, s.title, s.authors, s.publication_year, s.abstract, s.source_type,
+        1 + (s.embedding <#> :embedding) as similarity
+    FROM academic_sources s
+    JOIN candidates USING (id)
+    ORDER BY similarity
+    LIMIT :top_k
+""").bindparams(bindparam("candidates", type_=Integer), bindparam("top_k", type_=Integer))
+
+_SET_EF_SEARCH_SQL = text(f"SET LOCAL hnsw.ef_search = {int(HNSW_EF_SEARCH)}")
+_SET_RERANK_EF_SEARCH_SQL = text(f"SET LOCAL hnsw.ef_search = {int(RERANK_EF_SEARCH)}")
+_DISABLE_BITMAPSCAN_SQL = text("SET LOCAL enable_bitmapscan = off")
+
+_CACHED_QUERY_EMBEDDING_SQL = text(
+    "SELECT embedding FROM query_embedding_cache WHERE hash = :hash"
+).bindparams(bindparam("hash", type_=String))
+
+_STORE_QUERY_EMBEDDING_SQL = text("""
+    INSERT INTO query_embedding_cache (hash, embedding)
+    VALUES (:hash, CAST(:embedding AS vector))
+    ON CONFLICT DO NOTHING
+""").bindparams(bindparam("hash", type_=String))
+
+_MISSING_EMBEDDINGS_SQL = text("SELECT id, embedding_input FROM academic_sources WHERE embedding IS NULL")
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class SourceHit:
+    """One academic source returned by a similarity search"""
+    id: int
+    title: Optional[str]
+    authors: Optional[str]
+    publication_year: Optional[int]
+    abstract: Optional[str]
+    source_type: Optional[str]
+    similarity_score: float
+
+
+def _unit_length(embedding: List[float]) -> np.ndarray:
+    """Validate an embedding and scale it to unit length so inner product equals cosine similarity.
+    
+    Returns a float32 array, which pgvector's asyncpg codec writes without a per-element
+    Python conversion.
+    """
+    # np.array copies, so read-only inputs (e.g. np.frombuffer over decoded base64) are fine
+    vector = np.array(embedding, dtype=np.float32)
+    if vector.shape != (EMBEDDING_DIMENSIONS,) or not np.isfinite(vector).all():
+        raise ValueError(f"Expected {EMBEDDING_DIMENSIONS} finite values, got shape {vector.shape}")
+    vector /= np.linalg.norm(vector) or 1.0
+    return vector
+
+
+@functools.lru_cache(maxsize=1)
+def _embedding_encoding():
+    return tiktoken.encoding_for_model(EMBEDDING_MODEL)
+
+
+@functools.lru_cache(maxsize=1)
+def _analysis_encoding():
+    return tiktoken.encoding_for_model(ANALYSIS_MODEL)
+
+
+def _truncate_for_embedding(text: str) -> Tuple[str, int]:
+    """Cut text to the per-input token limit, returning it with its token count"""
+    encoding = _embedding_encoding()
+    tokens = encoding.encode(text)
+    if len(tokens) > EMBEDDING_MAX_INPUT_TOKENS:
+        tokens = tokens[:EMBEDDING_MAX_INPUT_TOKENS]
+        text = encoding.decode(tokens)
+    return text, len(tokens)
+
+
+def _split_by_tokens(texts: List[str]) -> Iterator[List[str]]:
+    """Split a window of texts into sub-batches that fit the embeddings token limits"""
+    batch, batch_tokens = [], 0
+    for input_text in texts:
+        input_text, token_count = _truncate_for_embedding(input_text)
+        if batch and batch_tokens + token_count > EMBEDDING_MAX_BATCH_TOKENS:
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(input_text)
+        batch_tokens += token_count
+    if batch:
+        yield batch
+
+
+@functools.lru_cache(maxsize=None)
+def _bulk_update_embeddings_sql(rows: int):
+    """UPDATE ... FROM (VALUES ...) writing `rows` embeddings in one statement"""
+    values = ", ".join(f"(CAST(:id_{i} AS integer), CAST(:emb_{i} AS halfvec))" for i in range(rows))
+    return text(f"""
+        UPDATE academic_sources AS s
+        SET embedding = v.embedding
+        FROM (VALUES {values}) AS v(id, embedding)
+        WHERE s.id = v.id
+    """)
+
+
+def _embedding_cache_key(text: str) -> str:
+    return hashlib.sha256(f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}\0{text}".encode("utf-8")).hexdigest()
+
 
 class RAGService:
     def __init__(self):
-        openai.api_key = config.settings.OPENAI_API_KEY
+        # First tier of the query embedding cache; query_embedding_cache table is the second
+        self._query_embeddings = LRUCache(maxsize=4096)
+        # Analyses keyed by a hash of the truncated text and the source ids
+        self._analyses = TTLCache(maxsize=1024, ttl=ANALYSIS_CACHE_TTL)
     
-    def get_embedding(self, text: str) -> List[float]:
-        """Generate embedding for text using OpenAI"""
+    # OpenAI clients are built on first use, so the app still imports (and auth/health keep
+    # working) when OPENAI_API_KEY is unset
+    @functools.cached_property
+    def client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(
+            api_key=config.settings.OPENAI_API_KEY,
+            # The SDK's client subclass keeps its defaults (e.g. following redirects) for anything not overridden
+            http_client=DefaultAsyncHttpxClient(http2=True, limits=OPENAI_HTTP_LIMITS, timeout=OPENAI_HTTP_TIMEOUT)
+        )
+    
+    async def aclose(self):
+        """Close the pooled OpenAI HTTP connections, if they were opened"""
+        if "client" in self.__dict__:
+            await self.client.close()
+    
+    async def get_embeddings(self, texts: List[str]) -> Optional[List[np.ndarray]]:
+        """Generate embeddings for several texts with a single OpenAI request"""
         try:
-            response = openai.embeddings.create(
-                input=text,
-                model="text-embedding-ada-002"
+            response = await self.client.embeddings.create(
+                input=texts,
+                model=EMBEDDING_MODEL,
+                dimensions=EMBEDDING_DIMENSIONS
             )
-            return response.data[0].embedding
+            return [_unit_length(d.embedding) for d in sorted(response.data, key=lambda d: d.index)]
         except Exception as e:
-            print(f"Error generating embedding: {e}")
+            logger.error("Error generating embeddings: %s", e)
+            return None
+    
+    async def get_embedding(self, text: str) -> Optional[np.ndarray]:
+        """Generate embedding for text using OpenAI"""
+        embeddings = await self.get_embeddings([text])
+        return embeddings[0] if embeddings else None
+    
+    async def get_query_embedding(self, db: AsyncSession, query: str) -> Optional[np.ndarray]:
+        """Embedding for a search query, served from the in-process or database cache when possible"""
+        normalized = " ".join(query.split())
+        key = _embedding_cache_key(normalized)
+        
+        embedding = self._query_embeddings.get(key)
+        if embedding is not None:
+            return embedding
+        
+        result = await db.execute(_CACHED_QUERY_EMBEDDING_SQL, {"hash": key})
+        embedding = result.scalar_one_or_none()
+        if embedding is None:
+            embedding = await self.get_embedding(normalized)
+            if embedding is None:
+                return None
+            await db.execute(_STORE_QUERY_EMBEDDING_SQL, {"hash": key, "embedding": embedding})
+            await db.commit()
+        
+        self._query_embeddings[key] = embedding
+        return embedding
+    
+    async def _embed_window(self, window, semaphore: asyncio.Semaphore) -> Optional[List[np.ndarray]]:
+        """Embeddings for one window of (id, embedding_input) rows, in row order"""
+        # Identical texts (e.g. re-ingested duplicates) are embedded once and fanned back out
+        positions: Dict[str, List[int]] = defaultdict(list)
+        for i, source in enumerate(window):
+            positions[source.embedding_input].append(i)
+        
+        unique_embeddings = []
+        for batch in _split_by_tokens(list(positions)):
+            async with semaphore:
+                batch_embeddings = await self.get_embeddings(batch)
+            if batch_embeddings is None:
+                return None
+            unique_embeddings.extend(batch_embeddings)
+        if len(unique_embeddings) != len(positions):
             return None
+        
+        embeddings = [None] * len(window)
+        for indexes, embedding in zip(positions.values(), unique_embeddings):
+            for i in indexes:
+                embeddings[i] = embedding
+        return embeddings
+    
+    @staticmethod
+    async def _write_embeddings(db: AsyncSession, source_ids: List[int], embeddings: List[np.ndarray]):
+        """Write up to EMBEDDING_BATCH_SIZE embeddings with one UPDATE statement"""
+        params = {}
+        for i, (source_id, embedding) in enumerate(zip(source_ids, embeddings)):
+            params[f"id_{i}"] = source_id
+            params[f"emb_{i}"] = embedding
+        await db.execute(_bulk_update_embeddings_sql(len(source_ids)), params)
     
-    def generate_and_store_embeddings_for_existing_sources(self, db: Session):
+    async def _embedded_windows(self, windows, semaphore: asyncio.Semaphore):
+        """Yield (window, embeddings) in stream order, embedding up to EMBEDDING_CONCURRENCY windows ahead"""
+        pending = deque()
+        try:
+            async for window in windows:
+                pending.append((window, asyncio.create_task(self._embed_window(window, semaphore))))
+                if len(pending) >= EMBEDDING_CONCURRENCY:
+                    window, task = pending.popleft()
+                    yield window, await task
+            while pending:
+                window, task = pending.popleft()
+                yield window, await task
+        finally:
+            for _, task in pending:
+                task.cancel()
+    
+    async def generate_and_store_embeddings_for_existing_sources(self, db: AsyncSession):
         """Generate and store embeddings for all academic sources that don't have them"""
         try:
-            # Get all sources without embeddings
-            sources_without_embeddings = db.query(models.AcademicSource).filter(
-                models.AcademicSource.embedding == None
-            ).all()
+            semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+            stored = written = 0
             
-            print(f"Found {len(sources_without_embeddings)} sources without embeddings")
+            # Stream (id, embedding_input) rows through a server-side cursor on a separate
+            # connection, so memory stays bounded and the periodic commits on `db` don't
+            # close the cursor. embedding_input is the stored "title. abstract" column.
+            # Embedding runs ahead of the writes, so the commit cadence never limits fan-out
+            with tqdm(desc="Embedding sources", unit="source", mininterval=1.0) as progress:
+                async with db.bind.connect() as reader:
+                    result = await reader.stream(
+                        _MISSING_EMBEDDINGS_SQL.execution_options(yield_per=500)
+                    )
+                    windows = self._embedded_windows(result.partitions(EMBEDDING_BATCH_SIZE), semaphore)
+                    async with contextlib.aclosing(windows):
+                        async for window, embeddings in windows:
+                            if embeddings is None or len(embeddings) != len(window):
+                                logger.warning("Failed to generate embeddings for %d sources", len(window))
+                                continue
+                            
+                            await self._write_embeddings(db, [source.id for source in window], embeddings)
+                            stored += len(window)
+                            progress.update(len(window))
+                            written += 1
+                            if written % BACKFILL_COMMIT_EVERY == 0:
+                                await db.commit()
+                    await db.commit()
             
-            for source in sources_without_embeddings:
-                # Create embedding text from title and abstract
-                embedding_text = f"{source.title}. {source.abstract}"
-                embedding = self.get_embedding(embedding_text)
-                
-                if embedding:
-                    # Convert to the format PostgreSQL expects
-                    embedding_array = "[" + ",".join(map(str, embedding)) + "]"
-                    
-                    # Update the source with the embedding
-                    update_sql = text("""
-                        UPDATE academic_sources 
-                        SET embedding = :embedding::vector 
-                        WHERE id = :source_id
-                    """)
-                    
-                    db.execute(update_sql, {
-                        "embedding": embedding_array,
-                        "source_id": source.id
-                    })
-                    
-                    print(f"✅ Added embedding for source: {source.title}")
-                else:
-                    print(f"❌ Failed to generate embedding for source: {source.title}")
-            
-            db.commit()
-            print("✅ All embeddings generated and stored successfully")
+            logger.info("Generated and stored embeddings for %d sources", stored)
             
         except Exception as e:
-            db.rollback()
-            print(f"❌ Error generating embeddings: {e}")
-
+            await db.rollback()
+            logger.error("Error generating embeddings: %s", e)
 
-    def search_similar_sources(self, db: Session, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        """Search for similar academic sources using vector similarity"""
-        query_embedding = self.get_embedding(query)
-        if not query_embedding:
-            print("Embedding generation failed")
-            return []
+    async def _submit_embedding_batch(self, lines: List[bytes]) -> str:
+        """Upload one JSONL input file and start a batch for it, returning the batch id"""
+        input_file = await self.client.files.create(
+            file=("embeddings.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/embeddings",
+            completion_window="24h"
+        )
+        logger.info("Submitted embedding batch %s for %d sources", batch.id, len(lines))
+        return batch.id
+    
+    async def submit_embedding_batches(self, db: AsyncSession) -> List[str]:
+        """Queue embeddings for all sources without them on OpenAI's Batch API (24h, ~50% cheaper).
+        
+        Meant for large historical backfills; returns the batch ids to pass to
+        apply_embedding_batch. Incremental backfills keep using the synchronous path.
+        Input files are split at EMBEDDING_BATCH_API_MAX_REQUESTS lines or
+        EMBEDDING_BATCH_API_MAX_BYTES, whichever comes first.
+        """
+        batch_ids = []
+        lines, size = [], 0
+        async with db.bind.connect() as reader:
+            result = await reader.stream(_MISSING_EMBEDDINGS_SQL.execution_options(yield_per=500))
+            async for row in result:
+                line = orjson.dumps({
+                    "custom_id": str(row.id),
+                    "method": "POST",
+                    "url": "/v1/embeddings",
+                    "body": {
+                        "model": EMBEDDING_MODEL,
+                        "dimensions": EMBEDDING_DIMENSIONS,
+                        "encoding_format": "base64",
+                        "input": _truncate_for_embedding(row.embedding_input)[0],
+                    },
+                })
+                # +1 for the newline joining it to the previous line
+                if lines and (len(lines) == EMBEDDING_BATCH_API_MAX_REQUESTS
+                              or size + len(line) + 1 > EMBEDDING_BATCH_API_MAX_BYTES):
+                    batch_ids.append(await self._submit_embedding_batch(lines))
+                    lines, size = [], 0
+                lines.append(line)
+                size += len(line) + 1
+            if lines:
+                batch_ids.append(await self._submit_embedding_batch(lines))
+        return batch_ids
+    
+    async def apply_embedding_batch(self, db: AsyncSession, batch_id: str, wait: bool = False) -> bool:
+        """Store the results of a finished embedding batch.
+        
+        Returns False while the batch is still running, unless wait=True, in which case it
+        polls every EMBEDDING_BATCH_API_POLL_SECONDS until the batch reaches a final state.
+        """
+        batch = await self.client.batches.retrieve(batch_id)
+        while wait and batch.status in ("validating", "in_progress", "finalizing"):
+            await asyncio.sleep(EMBEDDING_BATCH_API_POLL_SECONDS)
+            batch = await self.client.batches.retrieve(batch_id)
         
-        embedding_str = "[" + ",".join(map(str, query_embedding)) + "]"
-        print(f"Query: {query}, Embedding length: {len(query_embedding)}")
+        if batch.status != "completed":
+            logger.info("Embedding batch %s is %s", batch_id, batch.status)
+            return False
         
-        query_sql = text("""
-            SELECT id, title, authors, publication_year, abstract, source_type,
-                embedding <=> :embedding as similarity
-            FROM academic_sources
-            ORDER BY similarity
-            LIMIT :top_k
-        """)
+        # Requests that failed outright are written to a separate error file, not the output file.
+        # Both files are streamed line by line; a full batch's output runs to hundreds of MB
+        if batch.error_file_id:
+            failed, sample = 0, []
+            async with self.client.files.with_streaming_response.content(batch.error_file_id) as errors:
+                async for line in errors.iter_lines():
+                    if not line:
+                        continue
+                    failed += 1
+                    if len(sample) < 10:
+                        sample.append(str(orjson.loads(line).get("custom_id")))
+            if failed:
+                logger.warning(
+                    "%d embedding requests failed in batch %s (first ids: %s)",
+                    failed, batch_id, ", ".join(sample)
+                )
         
-        results = db.execute(query_sql, {"embedding": embedding_str, "top_k": top_k})
+        if not batch.output_file_id:
+            logger.info("Embedding batch %s produced no output", batch_id)
+            return False
         
+        stored = 0
+        source_ids, embeddings = [], []
+        try:
+            async with self.client.files.with_streaming_response.content(batch.output_file_id) as output:
+                async for line in output.iter_lines():
+                    if not line:
+                        continue
+                    item = orjson.loads(line)
+                    response = item.get("response") or {}
+                    if response.get("status_code") != 200:
+                        logger.warning("Embedding request %s failed in batch %s", item.get("custom_id"), batch_id)
+                        continue
+                    try:
+                        # Requested as base64: little-endian float32, about a quarter the size of float JSON
+                        raw = base64.b64decode(response["body"]["data"][0]["embedding"])
+                        embedding = _unit_length(np.frombuffer(raw, dtype="<f4"))
+                    except ValueError as e:
+                        logger.warning("Invalid embedding for %s in batch %s: %s", item.get("custom_id"), batch_id, e)
+                        continue
+                    source_ids.append(int(item["custom_id"]))
+                    embeddings.append(embedding)
+                    
+                    if len(source_ids) == EMBEDDING_BATCH_SIZE:
+                        await self._write_embeddings(db, source_ids, embeddings)
+                        stored += len(source_ids)
+                        source_ids, embeddings = [], []
+            if source_ids:
+                await self._write_embeddings(db, source_ids, embeddings)
+                stored += len(source_ids)
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logger.error("Error storing embedding batch %s: %s", batch_id, e)
+            return False
+        
+        logger.info("Stored %d embeddings from batch %s", stored, batch_id)
+        return True
+
+    @staticmethod
+    def _source_hits(results) -> List[SourceHit]:
         sources = []
-        for i, row in enumerate(results):
-            print(f"Row {i}: similarity = {row[6]}, type = {type(row[6])}")
-            
+        for m in results.mappings():
             # Safe conversion
-            similarity = row[6]
+            similarity = m["similarity"]
             if similarity is None:
-                print(f"Warning: NULL similarity for record {row[0]}")
+                logger.warning("NULL similarity for source %s", m["id"])
                 similarity = 1.0
                 
-            sources.append({
-                "id": row[0],
-                "title": row[1],
-                "authors": row[2],
-                "publication_year": row[3],
-                "abstract": row[4],
-                "source_type": row[5],
-                "similarity_score": float(similarity)
-            })
-        
-        print(f"Found {len(sources)} sources")
+            sources.append(SourceHit(
+                id=m["id"],
+                title=m["title"],
+                authors=m["authors"],
+                publication_year=m["publication_year"],
+                abstract=m["abstract"],
+                source_type=m["source_type"],
+                similarity_score=float(similarity)
+            ))
+        
+        logger.debug("Found %d sources", len(sources))
         return sources
-     
     
+    async def search_similar_sources(self, db: AsyncSession, query: str, top_k: int = 5) -> List[SourceHit]:
+        """Search for similar academic sources using vector similarity"""
+        query_embedding = await self.get_query_embedding(db, query)
+        if query_embedding is None:
+            logger.warning("Embedding generation failed")
+            return []
+        
+        # SET LOCAL applies to the transaction the search query runs in. Bitmap scans are
+        # disabled so filtered searches cannot fall back to a plan that ignores the HNSW ordering
+        await db.execute(_SET_EF_SEARCH_SQL)
+        await db.execute(_DISABLE_BITMAPSCAN_SQL)
+        results = await db.execute(_SEARCH_SQL, {"embedding": query_embedding, "top_k": top_k})
+        return self._source_hits(results)
+    
+    async def search_similar_sources_reranked(self, db: AsyncSession, query: str, top_k: int = 5) -> List[SourceHit]:
+        """Two-stage search: coarse Hamming-distance candidates, reranked by exact distance"""
+        query_embedding = await self.get_query_embedding(db, query)
+        if query_embedding is None:
+            logger.warning("Embedding generation failed")
+            return []
+        
+        await db.execute(_SET_RERANK_EF_SEARCH_SQL)
+        await db.execute(_DISABLE_BITMAPSCAN_SQL)
+        results = await db.execute(
+            _RERANKED_SEARCH_SQL,
+            {"embedding": query_embedding, "candidates": RERANK_CANDIDATES, "top_k": top_k}
+        )
+        return self._source_hits(results)
 
 
-
-
-    
-    def analyze_assignment_content(self, text: str, similar_sources: List[Dict]) -> Dict[str, Any]:
+    async def analyze_assignment_content(self, text: str, similar_sources: List[SourceHit]) -> Dict[str, Any]:
         """Analyze assignment content using AI"""
+        # Source ids are part of the cache key; checked before the fallback below can hide a bad input
+        source_ids = [source.id for source in similar_sources[:3]]
+        if any(source_id is None for source_id in source_ids):
+            raise ValueError("Sources passed for analysis must have ids")
+        
         try:
+            # Truncate by tokens rather than characters so no token is split
+            encoding = _analysis_encoding()
+            text = encoding.decode(encoding.encode(text)[:ANALYSIS_MAX_INPUT_TOKENS])
+            
+            source_ids = ",".join(map(str, source_ids))
+            cache_key = hashlib.sha256(f"{source_ids}\0{text}".encode("utf-8")).hexdigest()
+            # Callers get copies so they cannot modify the cached analysis
+            cached = self._analyses.get(cache_key)
+            if cached is not None:
+                return copy.deepcopy(cached)
+            
             sources_context = "\n".join([
-                f"Source {i+1}: {source['title']} by {source['authors']} ({source['publication_year']}) - {source['abstract'][:200]}..."
+                f"Source {i+1}: {source.title} by {source.authors} ({source.publication_year}) - {(source.abstract or '')[:200]}..."
                 for i, source in enumerate(similar_sources[:3])
             ])
             
@@ -125,7 +538,7 @@ class RAGService:
             Analyze the following academic assignment and provide structured analysis:
             
             ASSIGNMENT TEXT:
-            {text[:2000]}...
+            {text}...
             
             RELEVANT SOURCES:
             {sources_context}
@@ -140,19 +553,23 @@ class RAGService:
             - plagiarism_risk: assessment of plagiarism risk level (low/medium/high)
             """
             
-            response = openai.chat.completions.create(
-                model="gpt-3.5-turbo",
+            response = await self.client.chat.completions.create(
+                model=ANALYSIS_MODEL,
                 messages=[
                     {"role": "system", "content": "You are an academic research assistant. Provide structured JSON analysis of academic assignments."},
                     {"role": "user", "content": prompt}
                 ],
-                response_format={"type": "json_object"}
+                response_format={"type": "json_object"},
+                max_tokens=ANALYSIS_MAX_OUTPUT_TOKENS,
+                temperature=0
             )
             
-            return json.loads(response.choices[0].message.content)
+            analysis = json.loads(response.choices[0].message.content)
+            self._analyses[cache_key] = analysis
+            return copy.deepcopy(analysis)
             
         except Exception as e:
-            print(f"Error in AI analysis: {e}")
+            logger.error("Error in AI analysis: %s", e)
             return {
                 "topic": "Unknown",
                 "key_themes": [],
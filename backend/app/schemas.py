@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, ConfigDict, EmailStr
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
@@ -15,8 +15,7 @@ class StudentResponse(BaseModel):
     student_id: str
     created_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class Token(BaseModel):
     access_token: str
@@ -35,8 +34,7 @@ class AssignmentResponse(BaseModel):
     academic_level: Optional[str]
     uploaded_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class AnalysisResultResponse(BaseModel):
     id: int
@@ -49,8 +47,7 @@ class AnalysisResultResponse(BaseModel):
     confidence_score: float
     analyzed_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class SourceSearchResponse(BaseModel):
     query: str
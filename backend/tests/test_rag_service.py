@@ -0,0 +1,195 @@
+import asyncio
+import base64
+import contextlib
+from types import SimpleNamespace
+
+import numpy as np
+import orjson
+import pytest
+
+from app import rag_service
+from app.rag_service import EMBEDDING_CONCURRENCY, EMBEDDING_DIMENSIONS, RAGService, SourceHit, _unit_length
+
+
+def test_unit_length_returns_normalized_float32():
+    vector = _unit_length([3.0] * EMBEDDING_DIMENSIONS)
+    assert isinstance(vector, np.ndarray)
+    assert vector.dtype == np.float32
+    assert np.allclose(np.linalg.norm(vector), 1.0)
+
+
+def test_unit_length_keeps_zero_vector():
+    vector = _unit_length([0.0] * EMBEDDING_DIMENSIONS)
+    assert vector.dtype == np.float32
+    assert not vector.any()
+
+
+@pytest.mark.parametrize("size", [EMBEDDING_DIMENSIONS - 1, EMBEDDING_DIMENSIONS + 1, 1536])
+def test_unit_length_rejects_wrong_dimensions(size):
+    with pytest.raises(ValueError):
+        _unit_length([1.0] * size)
+
+
+def test_unit_length_rejects_non_finite_values():
+    embedding = [1.0] * EMBEDDING_DIMENSIONS
+    embedding[0] = float("nan")
+    with pytest.raises(ValueError):
+        _unit_length(embedding)
+
+
+def test_embedded_windows_fans_out_and_keeps_order():
+    in_flight = peak = 0
+
+    class CountingService(RAGService):
+        async def _embed_window(self, window, semaphore):
+            nonlocal in_flight, peak
+            async with semaphore:
+                in_flight += 1
+                peak = max(peak, in_flight)
+                await asyncio.sleep(0.01)
+                in_flight -= 1
+            return [window]
+
+    async def windows():
+        for i in range(EMBEDDING_CONCURRENCY * 3):
+            yield i
+
+    async def collect():
+        service = CountingService()
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        return [window async for window, _ in service._embedded_windows(windows(), semaphore)]
+
+    assert asyncio.run(collect()) == list(range(EMBEDDING_CONCURRENCY * 3))
+    assert peak == EMBEDDING_CONCURRENCY
+
+
+class _FakeChatClient:
+    """Stands in for AsyncOpenAI, recording prompts and answering with a fixed analysis"""
+
+    def __init__(self):
+        self.prompts = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **kwargs):
+        self.prompts.append(kwargs["messages"][-1]["content"])
+        message = SimpleNamespace(content='{"topic": "Machine learning"}')
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class _CharEncoding:
+    """One token per character, so tests need not download a tiktoken encoding"""
+
+    def encode(self, text):
+        return list(text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+@pytest.fixture
+def offline_encoding(monkeypatch):
+    monkeypatch.setattr(rag_service, "_analysis_encoding", _CharEncoding)
+
+
+def _source_hit(source_id, title="A title", abstract="An abstract"):
+    return SourceHit(
+        id=source_id,
+        title=title,
+        authors="Smith, J.",
+        publication_year=2023,
+        abstract=abstract,
+        source_type="paper",
+        similarity_score=0.9,
+    )
+
+
+def test_analyze_assignment_content_accepts_source_hits(offline_encoding):
+    service = RAGService()
+    service.client = _FakeChatClient()
+    sources = [_source_hit(1, title="Machine Learning in Education"), _source_hit(2, abstract=None)]
+
+    analysis = asyncio.run(service.analyze_assignment_content("An essay on learning", sources))
+
+    assert analysis == {"topic": "Machine learning"}
+    assert "Machine Learning in Education" in service.client.prompts[0]
+
+
+def test_analysis_cache_is_keyed_by_source_ids(offline_encoding):
+    service = RAGService()
+    service.client = _FakeChatClient()
+
+    asyncio.run(service.analyze_assignment_content("Same text", [_source_hit(1)]))
+    asyncio.run(service.analyze_assignment_content("Same text", [_source_hit(2)]))
+    asyncio.run(service.analyze_assignment_content("Same text", [_source_hit(1)]))
+
+    assert len(service.client.prompts) == 2
+
+
+def test_analysis_rejects_sources_without_ids(offline_encoding):
+    service = RAGService()
+    service.client = _FakeChatClient()
+
+    with pytest.raises(ValueError):
+        asyncio.run(service.analyze_assignment_content("Some text", [_source_hit(None)]))
+    assert service.client.prompts == []
+
+
+class _FakeBatchClient:
+    """Stands in for AsyncOpenAI with one completed batch whose files are served line by line"""
+
+    def __init__(self, output_lines, error_lines):
+        files = {"output": output_lines, "errors": error_lines}
+        batch = SimpleNamespace(status="completed", output_file_id="output", error_file_id="errors")
+
+        async def retrieve(batch_id):
+            return batch
+
+        @contextlib.asynccontextmanager
+        async def content(file_id):
+            async def iter_lines():
+                for line in files[file_id]:
+                    yield line
+            yield SimpleNamespace(iter_lines=iter_lines)
+
+        self.batches = SimpleNamespace(retrieve=retrieve)
+        self.files = SimpleNamespace(with_streaming_response=SimpleNamespace(content=content))
+
+
+class _FakeSession:
+    def __init__(self):
+        self.commits = 0
+
+    async def commit(self):
+        self.commits += 1
+
+    async def rollback(self):
+        raise AssertionError("unexpected rollback")
+
+
+def _batch_output_line(source_id, embedding):
+    body = {"data": [{"embedding": base64.b64encode(np.asarray(embedding, dtype="<f4").tobytes()).decode()}]}
+    return orjson.dumps({"custom_id": str(source_id), "response": {"status_code": 200, "body": body}}).decode()
+
+
+def test_apply_embedding_batch_streams_base64_output(monkeypatch):
+    written = []
+
+    async def write_embeddings(db, source_ids, embeddings):
+        written.extend(zip(source_ids, embeddings))
+
+    monkeypatch.setattr(RAGService, "_write_embeddings", staticmethod(write_embeddings))
+    service = RAGService()
+    service.client = _FakeBatchClient(
+        output_lines=[
+            _batch_output_line(1, [2.0] * EMBEDDING_DIMENSIONS),
+            "",
+            _batch_output_line(2, [1.0] * (EMBEDDING_DIMENSIONS - 1)),
+        ],
+        error_lines=[orjson.dumps({"custom_id": "3", "error": {"message": "failed"}}).decode()],
+    )
+    db = _FakeSession()
+
+    assert asyncio.run(service.apply_embedding_batch(db, "batch_1")) is True
+    assert [source_id for source_id, _ in written] == [1]
+    assert np.allclose(np.linalg.norm(written[0][1]), 1.0)
+    assert db.commits == 1
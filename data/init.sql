@@ -34,6 +34,9 @@ CREATE TABLE IF NOT EXISTS analysis_results (
     analyzed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX IF NOT EXISTS idx_assignments_student_id ON assignments (student_id);
+CREATE INDEX IF NOT EXISTS idx_analysis_results_assignment_id ON analysis_results (assignment_id);
+
 CREATE TABLE IF NOT EXISTS academic_sources (
     id SERIAL PRIMARY KEY,
     title TEXT,
@@ -42,7 +45,28 @@ CREATE TABLE IF NOT EXISTS academic_sources (
     abstract TEXT,
     full_text TEXT,
     source_type TEXT,
-    embedding VECTOR(1536)
+    -- Embedding widths here (512) must match Settings.EMBEDDING_DIMENSIONS in backend/app/config.py
+    embedding HALFVEC(512),
+    embedding_input TEXT GENERATED ALWAYS AS (coalesce(title, '') || '. ' || coalesce(abstract, '')) STORED
+);
+
+-- Keeps the embedding backfill scan small once most sources have embeddings
+CREATE INDEX IF NOT EXISTS idx_academic_sources_missing_embedding ON academic_sources (id)
+    WHERE embedding IS NULL;
+
+-- Approximate nearest-neighbour index for inner-product (<#>) searches over unit-length embeddings
+CREATE INDEX IF NOT EXISTS idx_academic_sources_embedding_hnsw ON academic_sources
+    USING hnsw (embedding halfvec_ip_ops) WITH (m = 16, ef_construction = 64);
+
+-- Binary-quantized (Hamming distance, <~>) index for the candidate stage of reranked searches
+CREATE INDEX IF NOT EXISTS idx_academic_sources_embedding_bit_hnsw ON academic_sources
+    USING hnsw ((binary_quantize(embedding)::bit(512)) bit_hamming_ops) WITH (m = 16, ef_construction = 64);
+
+-- Query embeddings keyed by sha256(model || ':' || dimensions || '\0' || text), so repeated searches skip the OpenAI call
+CREATE TABLE IF NOT EXISTS query_embedding_cache (
+    hash TEXT PRIMARY KEY,
+    embedding VECTOR(512) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Insert sample academic sources (these will be used for RAG)
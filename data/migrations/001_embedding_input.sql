@@ -0,0 +1,9 @@
+-- Upgrade for databases created before academic_sources.embedding_input existed.
+-- init.sql only runs on a fresh volume; apply this once with psql against an existing one.
+
+ALTER TABLE academic_sources ADD COLUMN IF NOT EXISTS embedding_input TEXT
+    GENERATED ALWAYS AS (coalesce(title, '') || '. ' || coalesce(abstract, '')) STORED;
+
+-- Keeps the embedding backfill scan small once most sources have embeddings
+CREATE INDEX IF NOT EXISTS idx_academic_sources_missing_embedding ON academic_sources (id)
+    WHERE embedding IS NULL;
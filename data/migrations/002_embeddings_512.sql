@@ -0,0 +1,35 @@
+-- Upgrade for databases created with 1536-dimension text-embedding-ada-002 embeddings.
+-- Brings academic_sources and query_embedding_cache in line with init.sql. Apply after
+-- 001_embedding_input.sql. Stored embeddings are cleared and must be regenerated afterwards.
+-- The 512 widths below must match Settings.EMBEDDING_DIMENSIONS in backend/app/config.py.
+
+-- halfvec and binary_quantize need pgvector 0.7+
+ALTER EXTENSION vector UPDATE;
+
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS idx_assignments_student_id ON assignments (student_id);
+CREATE INDEX IF NOT EXISTS idx_analysis_results_assignment_id ON analysis_results (assignment_id);
+
+-- The old indexes are built for the old type and width
+DROP INDEX IF EXISTS idx_academic_sources_embedding_hnsw;
+DROP INDEX IF EXISTS idx_academic_sources_embedding_bit_hnsw;
+
+-- 1536-d vectors cannot be truncated into the new space, so every source is re-embedded
+ALTER TABLE academic_sources ALTER COLUMN embedding TYPE HALFVEC(512) USING NULL;
+
+CREATE INDEX idx_academic_sources_embedding_hnsw ON academic_sources
+    USING hnsw (embedding halfvec_ip_ops) WITH (m = 16, ef_construction = 64);
+
+CREATE INDEX idx_academic_sources_embedding_bit_hnsw ON academic_sources
+    USING hnsw ((binary_quantize(embedding)::bit(512)) bit_hamming_ops) WITH (m = 16, ef_construction = 64);
+
+-- Cached query embeddings have the old width and keys, so the cache starts empty
+DROP TABLE IF EXISTS query_embedding_cache;
+CREATE TABLE query_embedding_cache (
+    hash TEXT PRIMARY KEY,
+    embedding VECTOR(512) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMIT;